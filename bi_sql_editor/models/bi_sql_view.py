@@ -2,13 +2,14 @@
 # @author: Sylvain LE GAL (https://twitter.com/legalsylvain)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import json
 import logging
 from datetime import datetime, timedelta
 
 from psycopg2 import ProgrammingError
 from psycopg2.sql import SQL, Identifier
 
-from odoo import SUPERUSER_ID, _, api, fields, models
+from odoo import SUPERUSER_ID, _, api, fields, models, tools
 from odoo.exceptions import UserError, ValidationError
 from odoo.tools import sql
 from odoo.tools.safe_eval import safe_eval
@@ -26,6 +27,10 @@ class BiSQLView(models.Model):
 
     _model_prefix = "x_bi_sql_view."
 
+    # Each check creates a view and updates the fields of the SQL view,
+    # so the SQL views are checked one by one
+    _check_execution_batch_enabled = False
+
     _sql_request_groups_relation = "bi_sql_view_groups_rel"
 
     _sql_request_users_relation = "bi_sql_view_users_rel"
@@ -35,6 +40,10 @@ class BiSQLView(models.Model):
         ("ui_valid", "Views, Action and Menu Created"),
     ]
 
+    _VIEW_ORDER_ALLOWED = frozenset(("graph", "pivot", "list"))
+
+    _GROUP_OPERATOR_CACHE_KEY = "bi_sql_view_group_operator"
+
     technical_name = fields.Char(
         required=True,
         help="Suffix of the SQL view. SQL full name will be computed and"
@@ -159,8 +168,8 @@ class BiSQLView(models.Model):
     # Constrains Section
     @api.constrains("is_materialized")
     def _check_index_materialized(self):
-        for rec in self.filtered(lambda x: not x.is_materialized):
-            if rec.bi_sql_view_field_ids.filtered(lambda x: x.is_index):
+        for rec in self.filtered_domain([("is_materialized", "=", False)]):
+            if rec.bi_sql_view_field_ids.filtered_domain([("is_index", "=", True)]):
                 raise UserError(
                     _("You can not create indexes on non materialized views")
                 )
@@ -168,12 +177,10 @@ class BiSQLView(models.Model):
     @api.constrains("view_order")
     def _check_view_order(self):
         for rec in self:
-            if rec.view_order:
-                for vtype in rec.view_order.split(","):
-                    if vtype not in ("graph", "pivot", "list"):
-                        raise UserError(
-                            _("Only graph, pivot or list views are supported")
-                        )
+            if rec.view_order and (
+                set(rec.view_order.split(",")) - self._VIEW_ORDER_ALLOWED
+            ):
+                raise UserError(_("Only graph, pivot or list views are supported"))
 
     # Compute Section
     @api.depends("bi_sql_view_field_ids.graph_type")
@@ -184,27 +191,25 @@ class BiSQLView(models.Model):
                 "pivot_row_groupby": [],
                 "pivot_column_groupby": [],
             }
-            for field in rec.bi_sql_view_field_ids.filtered(
-                lambda x: x.graph_type == "measure"
-            ):
-                action["pivot_measures"].append(field.name)
+            by_graph_type = {
+                "measure": action["pivot_measures"],
+                "row": action["pivot_row_groupby"],
+                "col": action["pivot_column_groupby"],
+            }
+            # Dispatch the fields in a single pass, instead of filtering
+            # the fields once per graph type
+            for field in rec.bi_sql_view_field_ids:
+                if field.graph_type in by_graph_type:
+                    by_graph_type[field.graph_type].append(field.name)
 
             # If no measure are defined, we display by default the count
             # of the element, to avoid an empty view
             if not action["pivot_measures"]:
                 action["pivot_measures"] = ["__count__"]
 
-            for field in rec.bi_sql_view_field_ids.filtered(
-                lambda x: x.graph_type == "row"
-            ):
-                action["pivot_row_groupby"].append(field.name)
-
-            for field in rec.bi_sql_view_field_ids.filtered(
-                lambda x: x.graph_type == "col"
-            ):
-                action["pivot_column_groupby"].append(field.name)
-
-            rec.computed_action_context = str(action)
+            # The field is not stored: this assignment only fills the cache
+            # and doesn't invalidate or recompute anything else
+            rec.computed_action_context = json.dumps(action)
 
     @api.depends("is_materialized")
     def _compute_materialized_text(self):
@@ -226,6 +231,8 @@ class BiSQLView(models.Model):
     # Overload Section
     def write(self, vals):
         res = super().write(vals)
+        if "technical_name" in vals:
+            self._invalidate_manual_fields_group_operator()
         if vals.get("sequence", False):
             for rec in self.filtered(lambda x: x.menu_id):
                 rec.menu_id.sequence = rec.sequence
@@ -241,57 +248,57 @@ class BiSQLView(models.Model):
                 )
             )
 
-    def copy(self, default=None):
-        self.ensure_one()
+    def copy_data(self, default=None):
         default = dict(default or {})
-        if "name" not in default:
-            default["name"] = _("%s (Copy)") % self.name
-        if "technical_name" not in default:
-            default["technical_name"] = f"{self.technical_name}_copy"
-        return super().copy(default=default)
+        vals_list = super().copy_data(default=default)
+        for sql_view, vals in zip(self, vals_list, strict=True):
+            if "name" not in default:
+                vals["name"] = _("%s (Copy)") % sql_view.name
+            if "technical_name" not in default:
+                vals["technical_name"] = f"{sql_view.technical_name}_copy"
+        return vals_list
 
     # Action Section
     def button_create_sql_view_and_model(self):
-        for sql_view in self.filtered(lambda x: x.state == "sql_valid"):
-            # Check if many2one fields are correctly
-            bad_fields = sql_view.bi_sql_view_field_ids.filtered(
-                lambda x: x.ttype == "many2one" and not x.many2one_model_id.id
+        sql_views = self.filtered_domain([("state", "=", "sql_valid")])
+        # Check if many2one fields are correctly set, for all the views at once
+        bad_fields = sql_views.bi_sql_view_field_ids.filtered(
+            lambda x: x.ttype == "many2one" and not x.many2one_model_id
+        )
+        if bad_fields:
+            raise ValidationError(
+                _("Please set related models on the following fields %s")
+                % ",".join(bad_fields.mapped("name"))
             )
-            if bad_fields:
-                raise ValidationError(
-                    _("Please set related models on the following fields %s")
-                    % ",".join(bad_fields.mapped("name"))
-                )
-            # Create ORM and access
-            sql_view._create_model_and_fields()
-            sql_view._create_model_access()
+        # Create ORM and access
+        sql_views._create_model_and_fields()
+        sql_views._create_model_access()
 
-            # Create SQL View and indexes
-            sql_view._create_view()
-            sql_view._create_index()
+        # Create SQL View and indexes
+        sql_views._create_view()
+        sql_views._create_index()
 
-            if sql_view.is_materialized:
-                if not sql_view.cron_id:
-                    sql_view.cron_id = (
-                        self.env["ir.cron"].create(sql_view._prepare_cron()).id
-                    )
-                else:
-                    sql_view.cron_id.active = True
-            sql_view.state = "model_valid"
+        materialized_views = sql_views.filtered(lambda x: x.is_materialized)
+        materialized_views.mapped("cron_id").write({"active": True})
+        for sql_view in materialized_views.filtered(lambda x: not x.cron_id):
+            sql_view.cron_id = self.env["ir.cron"].create(sql_view._prepare_cron()).id
+        sql_views.write({"state": "model_valid"})
 
     def button_reset_to_model_valid(self):
-        views = self.filtered(lambda x: x.state == "ui_valid")
-        views.mapped("tree_view_id").unlink()
-        views.mapped("graph_view_id").unlink()
-        views.mapped("pivot_view_id").unlink()
-        views.mapped("search_view_id").unlink()
+        views = self.filtered_domain([("state", "=", "ui_valid")])
+        (
+            views.mapped("tree_view_id")
+            | views.mapped("graph_view_id")
+            | views.mapped("pivot_view_id")
+            | views.mapped("search_view_id")
+        ).unlink()
         views.mapped("action_id").unlink()
         views.mapped("menu_id").unlink()
         return views.write({"state": "model_valid"})
 
     def button_reset_to_sql_valid(self):
         self.button_reset_to_model_valid()
-        views = self.filtered(lambda x: x.state == "model_valid")
+        views = self.filtered_domain([("state", "=", "model_valid")])
         for sql_view in views:
             # Drop SQL View (and indexes by cascade)
             if sql_view.is_materialized:
@@ -308,21 +315,31 @@ class BiSQLView(models.Model):
         return super().button_set_draft()
 
     def button_create_ui(self):
-        self.tree_view_id = self.env["ir.ui.view"].create(self._prepare_tree_view()).id
-        self.graph_view_id = (
-            self.env["ir.ui.view"].create(self._prepare_graph_view()).id
-        )
-        self.pivot_view_id = (
-            self.env["ir.ui.view"].create(self._prepare_pivot_view()).id
+        tree_view, graph_view, pivot_view, search_view = self.env["ir.ui.view"].create(
+            [
+                self._prepare_tree_view(),
+                self._prepare_graph_view(),
+                self._prepare_pivot_view(),
+                self._prepare_search_view(),
+            ]
         )
-        self.search_view_id = (
-            self.env["ir.ui.view"].create(self._prepare_search_view()).id
+        self.write(
+            {
+                "tree_view_id": tree_view.id,
+                "graph_view_id": graph_view.id,
+                "pivot_view_id": pivot_view.id,
+                "search_view_id": search_view.id,
+            }
         )
         self.action_id = (
             self.env["ir.actions.act_window"].create(self._prepare_action()).id
         )
-        self.menu_id = self.env["ir.ui.menu"].create(self._prepare_menu()).id
-        self.write({"state": "ui_valid"})
+        self.write(
+            {
+                "menu_id": self.env["ir.ui.menu"].create(self._prepare_menu()).id,
+                "state": "ui_valid",
+            }
+        )
 
     def button_update_model_access(self):
         self._drop_model_access()
@@ -330,7 +347,8 @@ class BiSQLView(models.Model):
         self.write({"has_group_changed": False})
 
     def button_refresh_materialized_view(self):
-        self._refresh_materialized_view()
+        sql_views = self.filtered_domain([("is_materialized", "=", True)])
+        sql_views._refresh_materialized_view()
 
     def button_open_view(self):
         return {
@@ -374,6 +392,7 @@ class BiSQLView(models.Model):
         return res
 
     def _prepare_cron(self):
+        self.ensure_one()
         now = datetime.now()
         return {
             "name": _("Refresh Materialized View %s") % self.view_name,
@@ -382,7 +401,7 @@ class BiSQLView(models.Model):
             .search([("model", "=", self._name)], limit=1)
             .id,
             "state": "code",
-            "code": f"model._refresh_materialized_view_cron({self.ids})",
+            "code": f"model._refresh_materialized_view_cron([{self.id}])",
             "interval_number": 1,
             "interval_type": "days",
             "nextcall": now + timedelta(days=1),
@@ -400,6 +419,7 @@ class BiSQLView(models.Model):
 
     def _prepare_tree_view(self):
         self.ensure_one()
+        sql_fields = self.bi_sql_view_field_ids
         return {
             "name": self.name,
             "type": "list",
@@ -407,12 +427,13 @@ class BiSQLView(models.Model):
             "arch": """<?xml version="1.0"?>"""
             """<list name="Analysis">{}"""
             """</list>""".format(
-                "".join([x._prepare_tree_field() for x in self.bi_sql_view_field_ids])
+                "".join([x._prepare_tree_field() for x in sql_fields])
             ),
         }
 
     def _prepare_graph_view(self):
         self.ensure_one()
+        sql_fields = self.bi_sql_view_field_ids
         return {
             "name": self.name,
             "type": "graph",
@@ -420,12 +441,13 @@ class BiSQLView(models.Model):
             "arch": """<?xml version="1.0"?>"""
             """<graph string="Analysis" type="bar" stacked="True">{}"""
             """</graph>""".format(
-                "".join([x._prepare_graph_field() for x in self.bi_sql_view_field_ids])
+                "".join([x._prepare_graph_field() for x in sql_fields])
             ),
         }
 
     def _prepare_pivot_view(self):
         self.ensure_one()
+        sql_fields = self.bi_sql_view_field_ids
         return {
             "name": self.name,
             "type": "pivot",
@@ -433,12 +455,13 @@ class BiSQLView(models.Model):
             "arch": """<?xml version="1.0"?>"""
             """<pivot string="Analysis" stacked="True">{}"""
             """</pivot>""".format(
-                "".join([x._prepare_pivot_field() for x in self.bi_sql_view_field_ids])
+                "".join([x._prepare_pivot_field() for x in sql_fields])
             ),
         }
 
     def _prepare_search_view(self):
         self.ensure_one()
+        sql_fields = self.bi_sql_view_field_ids
         return {
             "name": self.name,
             "type": "search",
@@ -447,15 +470,8 @@ class BiSQLView(models.Model):
             """<search string="Analysis">{}"""
             """<group expand="1" string="Group By">{}</group>"""
             """</search>""".format(
-                "".join(
-                    [x._prepare_search_field() for x in self.bi_sql_view_field_ids]
-                ),
-                "".join(
-                    [
-                        x._prepare_search_filter_field()
-                        for x in self.bi_sql_view_field_ids
-                    ]
-                ),
+                "".join([x._prepare_search_field() for x in sql_fields]),
+                "".join([x._prepare_search_filter_field() for x in sql_fields]),
             ),
         }
 
@@ -469,9 +485,6 @@ class BiSQLView(models.Model):
             view_id = self.pivot_view_id.id
         else:
             view_id = self.graph_view_id.id
-        action = safe_eval(self.computed_action_context)
-        for k, v in safe_eval(self.action_context).items():
-            action[k] = v
         return {
             "name": self._prepare_action_name(),
             "res_model": self.model_id.model,
@@ -479,17 +492,32 @@ class BiSQLView(models.Model):
             "view_mode": view_mode,
             "view_id": view_id,
             "search_view_id": self.search_view_id.id,
-            "context": str(action),
+            "context": self._get_action_context(
+                self.computed_action_context, self.action_context
+            ),
         }
 
-    def _prepare_action_name(self):
+    @api.model
+    @tools.ormcache("computed_action_context", "action_context")
+    def _get_action_context(self, computed_action_context, action_context):
+        """Return the context of the action, merging the computed context
+        and the context defined by the user. The result only depends on the
+        given texts, so it is cached to avoid evaluating them again."""
+        action = json.loads(computed_action_context)
+        for k, v in safe_eval(action_context).items():
+            action[k] = v
+        return str(action)
+
+    def _prepare_action_name(self, refresh_date_text=False):
         self.ensure_one()
         if not self.is_materialized:
             return self.name
-        return "{} ({})".format(
-            self.name,
-            datetime.utcnow().strftime("%m/%d/%Y %H:%M:%S UTC"),
-        )
+        refresh_date_text = refresh_date_text or self._get_refresh_date_text()
+        return f"{self.name} ({refresh_date_text})"
+
+    @api.model
+    def _get_refresh_date_text(self):
+        return datetime.utcnow().strftime("%m/%d/%Y %H:%M:%S UTC")
 
     def _prepare_menu(self):
         self.ensure_one()
@@ -548,19 +576,30 @@ class BiSQLView(models.Model):
                 )
 
     def _create_model_and_fields(self):
-        for sql_view in self:
-            # Create model
-            sql_view.model_id = self.env["ir.model"].create(self._prepare_model()).id
-            sql_view.rule_id = self.env["ir.rule"].create(self._prepare_rule()).id
+        # Create models
+        ir_models = self.env["ir.model"].create(
+            [sql_view._prepare_model() for sql_view in self]
+        )
+        for sql_view, ir_model in zip(self, ir_models, strict=True):
+            sql_view.model_id = ir_model.id
+        rules = self.env["ir.rule"].create(
+            [sql_view._prepare_rule() for sql_view in self]
+        )
+        for sql_view, rule in zip(self, rules, strict=True):
+            sql_view.rule_id = rule.id
             # Drop table, created by the ORM
             if sql.table_exists(self._cr, sql_view.view_name):
                 req = SQL("DROP TABLE {}").format(Identifier(sql_view.view_name))
                 self._log_execute(req)
 
     def _create_model_access(self):
+        # No explicit prefetch is required: group_ids of all the views, and
+        # the full_name of all their groups, are loaded in batch by the ORM
+        # on first access
+        vals_list = []
         for sql_view in self:
-            for item in sql_view._prepare_model_access():
-                self.env["ir.model.access"].create(item)
+            vals_list.extend(sql_view._prepare_model_access())
+        self.env["ir.model.access"].create(vals_list)
 
     def _drop_model_access(self):
         for sql_view in self:
@@ -628,30 +667,34 @@ class BiSQLView(models.Model):
         sql_view_field_obj = self.env["bi.sql.view.field"]
         columns = super()._check_execution()
         field_ids = []
+        new_field_vals_list = []
+        existing_fields = {x.name: x for x in self.bi_sql_view_field_ids}
         for column in columns:
-            existing_field = self.bi_sql_view_field_ids.filtered(
-                lambda x, c=column: x.name == c[1]
-            )
+            existing_field = existing_fields.get(column[1])
             if existing_field:
-                # Update existing field
+                # Update existing field, if required
                 field_ids.append(existing_field.id)
-                existing_field.write({"sequence": column[0], "sql_type": column[2]})
+                if (
+                    existing_field.sequence != column[0]
+                    or existing_field.sql_type != column[2]
+                ):
+                    existing_field.write({"sequence": column[0], "sql_type": column[2]})
             else:
                 # Create a new one if name is prefixed by x_
                 if column[1][:2] == "x_":
-                    field_ids.append(
-                        sql_view_field_obj.create(
-                            {
-                                "sequence": column[0],
-                                "name": column[1],
-                                "sql_type": column[2],
-                                "bi_sql_view_id": self.id,
-                            }
-                        ).id
+                    new_field_vals_list.append(
+                        {
+                            "sequence": column[0],
+                            "name": column[1],
+                            "sql_type": column[2],
+                            "bi_sql_view_id": self.id,
+                        }
                     )
+        if new_field_vals_list:
+            field_ids += sql_view_field_obj.create(new_field_vals_list).ids
 
         # Drop obsolete view field
-        self.bi_sql_view_field_ids.filtered(lambda x: x.id not in field_ids).unlink()
+        (self.bi_sql_view_field_ids - sql_view_field_obj.browse(field_ids)).unlink()
 
         if not self.bi_sql_view_field_ids:
             raise UserError(
@@ -672,60 +715,134 @@ class BiSQLView(models.Model):
         return sql_views._refresh_materialized_view()
 
     def _refresh_materialized_view(self):
-        for sql_view in self.filtered(lambda x: x.is_materialized):
-            req = f"REFRESH {sql_view.materialized_text} VIEW {sql_view.view_name}"
+        """Refresh the materialized views. The caller is in charge of
+        filtering the materialized views."""
+        unique_indexed_view_names = self._get_unique_indexed_view_names()
+        refresh_date_text = self._get_refresh_date_text()
+        action_env = self.with_context(
+            lang=self.env.context.get("lang", self.env.user.lang)
+        ).env
+        for sql_view in self:
+            # Refresh concurrently when possible, to avoid to lock
+            # the view for readers during the refresh
+            is_unique_indexed = sql_view.view_name in unique_indexed_view_names
+            concurrently_text = "CONCURRENTLY" if is_unique_indexed else ""
+            req = SQL("REFRESH {materialized_text} VIEW {concurrently} {name}").format(
+                materialized_text=SQL(sql_view.materialized_text),
+                concurrently=SQL(concurrently_text),
+                name=Identifier(sql_view.view_name),
+            )
             self._log_execute(req)
-            sql_view._refresh_size()
             if sql_view.action_id:
                 # Alter name of the action, to display last refresh
                 # datetime of the materialized view
-                sql_view.action_id.with_context(
-                    lang=self.env.context.get("lang", self.env.user.lang)
-                ).name = sql_view._prepare_action_name()
+                sql_view.action_id.with_env(
+                    action_env
+                ).name = sql_view._prepare_action_name(refresh_date_text)
+        self._refresh_size()
+
+    def _get_unique_indexed_view_names(self):
+        """Return the names of the views that have a valid unique index on
+        plain columns and without WHERE clause. Such an index is required to
+        refresh a materialized view concurrently."""
+        if not self:
+            return set()
+        # The names are resolved as regclass, as in the REFRESH request,
+        # to not match relations of the same name in other schemas
+        self.env.cr.execute(
+            """
+SELECT DISTINCT
+    c.relname
+FROM
+    pg_index i
+    INNER JOIN pg_class c ON c.oid = i.indrelid
+WHERE
+    i.indrelid = ANY(
+        SELECT quote_ident(v.name)::regclass FROM unnest(%s) AS v(name)
+    )
+    AND i.indisunique
+    AND i.indisvalid
+    AND i.indpred IS NULL
+    AND i.indexprs IS NULL
+;
+            """,
+            (self.mapped("view_name"),),
+        )
+        return {row[0] for row in self.env.cr.fetchall()}
 
     def _refresh_size(self):
+        if not self:
+            return
+        # Get the size of all the views in a single query
+        self.env.cr.execute(
+            """
+SELECT
+    v.name,
+    pg_size_pretty(pg_total_relation_size(quote_ident(v.name)::regclass))
+FROM
+    unnest(%s) AS v(name)
+;
+            """,
+            (self.mapped("view_name"),),
+        )
+        sizes = dict(self.env.cr.fetchall())
         for sql_view in self:
-            req = SQL("SELECT pg_size_pretty(pg_total_relation_size('{}'));").format(
-                Identifier(sql_view.view_name)
-            )
-            self._log_execute(req)
-            sql_view.size = self.env.cr.fetchone()[0]
+            sql_view.size = sizes[sql_view.view_name]
 
     def check_manual_fields(self, model):
+        if not model._name.startswith(self._model_prefix):
+            return
+        group_operators = self._get_manual_fields_group_operator()
+        for field_name, group_operator in group_operators.get(model._name, []):
+            if field_name in model._fields:
+                model._fields[field_name].group_operator = group_operator
+
+    @api.model
+    def _get_manual_fields_group_operator(self):
+        """Return a dict {model_name: [(field_name, group_operator)]} of the
+        numeric fields of all the SQL views that have a group operator.
+        The result is loaded with a single query, and cached for the current
+        transaction, as this is called for each model, during registry
+        loading."""
+        cache = self.env.cr.cache
+        if self._GROUP_OPERATOR_CACHE_KEY in cache:
+            return cache[self._GROUP_OPERATOR_CACHE_KEY]
+        res = {}
         # check the fields we need are defined on self, to stop it going
         # early on install / startup - particularly problematic during upgrade
-        if model._name.startswith(
-            self._model_prefix
-        ) and "group_operator" in sql.table_columns(self.env.cr, "bi_sql_view_field"):
+        if "group_operator" in sql.table_columns(self.env.cr, "bi_sql_view_field"):
             # Use SQL instead of ORM, as ORM might not be fully initialised -
             # we have no control over the order that fields are defined!
             # We are not concerned about user security rules.
             self.env.cr.execute(
                 """
 SELECT
+    v.model_name,
     f.name,
-    f.ttype,
     f.group_operator
 FROM
     bi_sql_view v
-    LEFT JOIN bi_sql_view_field f ON f.bi_sql_view_id = v.id
+    INNER JOIN bi_sql_view_field f ON f.bi_sql_view_id = v.id
 WHERE
-    v.model_name = %s
+    f.ttype IN ('integer', 'float')
+    AND f.group_operator IS NOT NULL
 ;
-                """,
-                (model._name,),
+                """
             )
-            sql_fields = self.env.cr.fetchall()
+            for model_name, field_name, group_operator in self.env.cr.fetchall():
+                res.setdefault(model_name, []).append((field_name, group_operator))
+            # Don't cache the result if the column doesn't exist yet, as it
+            # can be created later in the same transaction
+            cache[self._GROUP_OPERATOR_CACHE_KEY] = res
+        return res
 
-            for sql_field in sql_fields:
-                if (
-                    sql_field[0] in model._fields
-                    and sql_field[1] in ("integer", "float")
-                    and sql_field[2]
-                ):
-                    model._fields[sql_field[0]].group_operator = sql_field[2]
+    @api.model
+    def _invalidate_manual_fields_group_operator(self):
+        self.env.cr.cache.pop(self._GROUP_OPERATOR_CACHE_KEY, None)
 
     def button_preview_sql_expression(self):
+        # The check of the execution doesn't run the query, but is required
+        # to check the columns of the view
         self.button_validate_sql_expression()
-        res = self._execute_sql_request()
-        raise UserError("\n".join(map(lambda x: str(x), res[:100])))
+        res = self._get_preview_rows()
+        raise UserError("\n".join(map(str, res)))
@@ -156,6 +156,7 @@ class BiSQLViewField(models.Model):
     # Overload Section
     @api.model_create_multi
     def create(self, vals_list):
+        model_mapping = None
         for vals in vals_list:
             field_without_prefix = vals["name"][2:]
             # guess field description
@@ -177,7 +178,9 @@ class BiSQLViewField(models.Model):
             many2one_model_id = False
             if vals["sql_type"] == "integer" and (vals["name"][-3:] == "_id"):
                 ttype = "many2one"
-                model_name = self._model_mapping().get(field_without_prefix, "")
+                if model_mapping is None:
+                    model_mapping = self._model_mapping()
+                model_name = model_mapping.get(field_without_prefix, "")
                 many2one_model_id = (
                     self.env["ir.model"].search([("model", "=", model_name)]).id
                 )
@@ -189,8 +192,14 @@ class BiSQLViewField(models.Model):
                     "many2one_model_id": many2one_model_id,
                 }
             )
+        self.env["bi.sql.view"]._invalidate_manual_fields_group_operator()
         return super().create(vals_list)
 
+    def write(self, vals):
+        if {"name", "ttype", "group_operator", "bi_sql_view_id"} & vals.keys():
+            self.env["bi.sql.view"]._invalidate_manual_fields_group_operator()
+        return super().write(vals)
+
     def unlink(self):
         if self.filtered(lambda x: x.state in ("model_valid", "ui_valid")):
             raise UserError(
@@ -199,6 +208,7 @@ class BiSQLViewField(models.Model):
                     " is in the state 'Model Valid' or 'UI Valid'."
                 )
             )
+        self.env["bi.sql.view"]._invalidate_manual_fields_group_operator()
         return super().unlink()
 
     # Custom Section
@@ -1,6 +1,8 @@
 # Copyright 2017 Onestein (<http://www.onestein.eu>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from psycopg2.sql import SQL, Identifier
+
 from odoo.exceptions import AccessError, UserError, ValidationError
 from odoo.tests import tagged
 from odoo.tests.common import SingleTransactionCase
@@ -60,6 +62,49 @@ class TestBiSqlViewEditor(SingleTransactionCase):
         # Check that cron works correctly
         copy_view.cron_id.method_direct_trigger()
 
+    def test_refresh_concurrently(self):
+        copy_view = self.view.copy(
+            default={"technical_name": "test_refresh_concurrently"}
+        )
+        copy_view.button_validate_sql_expression()
+        copy_view.button_create_sql_view_and_model()
+        self.assertFalse(copy_view._get_unique_indexed_view_names())
+
+        self.env.cr.execute(
+            SQL("CREATE UNIQUE INDEX {index_name} ON {view_name} (id)").format(
+                index_name=Identifier(f"{copy_view.view_name}_unique_id"),
+                view_name=Identifier(copy_view.view_name),
+            )
+        )
+        self.assertEqual(
+            copy_view._get_unique_indexed_view_names(), {copy_view.view_name}
+        )
+        with self.assertLogs(
+            "odoo.addons.bi_sql_editor.models.bi_sql_view", level="INFO"
+        ) as logs:
+            copy_view.button_refresh_materialized_view()
+        self.assertIn("CONCURRENTLY", "\n".join(logs.output))
+
+    def test_group_operator(self):
+        copy_view = self.view.copy(default={"technical_name": "test_group_operator"})
+        copy_view.query = "SELECT name AS x_name, color AS x_color FROM res_partner"
+        copy_view.button_validate_sql_expression()
+        copy_view.button_create_sql_view_and_model()
+        color_field = copy_view.bi_sql_view_field_ids.filtered(
+            lambda x: x.name == "x_color"
+        )
+        self.assertEqual(color_field.ttype, "integer")
+        # Load the group operators in the cache of the transaction
+        self.bi_sql_view._get_manual_fields_group_operator()
+
+        color_field.group_operator = "max"
+        self.env.flush_all()
+        self.env.registry.setup_models(self.env.cr)
+        self.assertEqual(
+            self.env.registry[copy_view.model_name]._fields["x_color"].group_operator,
+            "max",
+        )
+
     def test_copy(self):
         copy_view = self.view.copy(default={"technical_name": "test_copy"})
         self.assertEqual(copy_view.name, f"{self.view.name} (Copy)")
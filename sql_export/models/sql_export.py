@@ -1,7 +1,7 @@
 # Copyright (C) 2015 Akretion (<http://www.akretion.com>)
 # @author: Florian da Costa
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class SqlExport(models.Model):
@@ -18,6 +18,19 @@ class SqlExport(models.Model):
     file_format = fields.Selection([("csv", "CSV")], default="csv", required=True)
 
     use_properties = fields.Boolean(compute="_compute_use_properties")
+
+    use_company_id_param = fields.Boolean(
+        compute="_compute_use_params",
+        store=True,
+        help="Technical field, checked if the query uses the parameter"
+        " %(company_id)s.",
+    )
+
+    use_user_id_param = fields.Boolean(
+        compute="_compute_use_params",
+        store=True,
+        help="Technical field, checked if the query uses the parameter %(user_id)s.",
+    )
     query_properties_definition = fields.PropertiesDefinition("Query Properties")
 
     encoding = fields.Selection(
@@ -41,6 +54,13 @@ class SqlExport(models.Model):
         for rec in self:
             rec.use_properties = bool(rec.query_properties_definition)
 
+    @api.depends("query")
+    def _compute_use_params(self):
+        for rec in self:
+            query = rec.query or ""
+            rec.use_company_id_param = "%(company_id)s" in query
+            rec.use_user_id_param = "%(user_id)s" in query
+
     def configure_properties(self):
         # we need a full window in order for property configuration to work, not a modal
         wiz = self.env["sql.file.wizard"].create({"sql_export_id": self.id})
@@ -83,9 +103,7 @@ class SqlExport(models.Model):
             res = res.decode(self.encoding)
         return res
 
-    def _check_execution(self):
+    def _check_execution_required(self):
         self.ensure_one()
         # only check execution if query does not contains variable
-        if self.query_properties_definition:
-            return True
-        return super()._check_execution()
+        return not self.query_properties_definition
@@ -3,10 +3,16 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
 import base64
+from unittest.mock import patch
 
 from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase, tagged
 
+from odoo.addons.sql_request_abstract.models.sql_request_mixin import (
+    ITER_SIZE,
+    SQLRequestMixin,
+)
+
 
 @tagged("post_install", "-at_install")
 class TestExportSqlQuery(TransactionCase):
@@ -46,9 +52,44 @@ class TestExportSqlQuery(TransactionCase):
                 )
                 sql_export.button_validate_sql_expression()
 
+    def test_invalid_syntax_queries(self):
+        invalid_queries = [
+            "res_partner",
+            "SELECT name FROM res_partner WHERE id IN (1, 2",
+            "SELECT name FROM res_partner WHERE name = 'test",
+            "SELECT name FROM res_partner /* comment",
+            "/* nested /* comment */ SELECT name FROM res_partner",
+            "SELECT name FROM res_partner /* nested /* comment */",
+        ]
+        for query in invalid_queries:
+            sql_export = self.sql_export_obj.create(
+                {"name": "test_invalid_syntax", "query": query}
+            )
+            with self.assertRaises(UserError):
+                sql_export._check_syntax()
+
+    def test_invalid_syntax_queries_without_backtracking(self):
+        # These queries took an exponential time to be rejected, with a
+        # regex subject to catastrophic backtracking
+        invalid_queries = [
+            "-- comment\n" + "-" * 1000 + "\n* FROM res_partner",
+            "-- comment\n" + "    \n" * 1000 + '"x_name" FROM res_partner',
+            " " * 1000 + "#",
+        ]
+        for query in invalid_queries:
+            sql_export = self.sql_export_obj.create(
+                {"name": "test_invalid_syntax", "query": query}
+            )
+            with self.assertRaises(UserError):
+                sql_export._check_syntax()
+
     def test_authorized_queries(self):
         authorized_queries = [
             "SELECT create_date FROM res_partner",
+            "-- comment\nSELECT name FROM res_partner WHERE name != ')'",
+            "/* comment */\n" + "-" * 40 + "\nSELECT name FROM res_partner",
+            "SELECT name FROM res_partner -- comment",
+            "/* nested /* comment */ */ SELECT name FROM res_partner",
         ]
 
         for query in authorized_queries:
@@ -60,6 +101,80 @@ class TestExportSqlQuery(TransactionCase):
                 sql_export.state, "sql_valid", f"{query} is a valid request"
             )
 
+    def test_validate_many_queries(self):
+        sql_exports = self.sql_export_obj.create(
+            [
+                {"name": "test_many_1", "query": "SELECT name FROM res_partner"},
+                {"name": "test_many_2", "query": "SELECT name FROM res_users"},
+                {"name": "test_many_3", "query": "SELECT name FROM res_company"},
+            ]
+        )
+        with patch.object(
+            SQLRequestMixin,
+            "_create_savepoint",
+            autospec=True,
+            side_effect=SQLRequestMixin._create_savepoint,
+        ) as create_savepoint:
+            sql_exports.button_validate_sql_expression()
+        # The requests are checked within a single savepoint
+        create_savepoint.assert_called_once()
+        self.assertEqual(set(sql_exports.mapped("state")), {"sql_valid"})
+
+        sql_exports = self.sql_export_obj.create(
+            [
+                {"name": "test_many_4", "query": "SELECT name FROM res_partner"},
+                {"name": "test_many_5", "query": "SELECT name FROM unexisting_table"},
+            ]
+        )
+        with self.assertRaises(UserError):
+            sql_exports.button_validate_sql_expression()
+
+    def _get_iter_sql_export(self):
+        sql_export = self.sql_export_obj.create(
+            {
+                "name": "test_iter",
+                "query": "SELECT value FROM generate_series(1, %s) AS value"
+                % (ITER_SIZE * 2 + 1),
+            }
+        )
+        sql_export.button_validate_sql_expression()
+        return sql_export
+
+    def test_sql_query_iter(self):
+        sql_export = self._get_iter_sql_export()
+        with patch.object(
+            SQLRequestMixin,
+            "_rollback_savepoint",
+            autospec=True,
+            side_effect=SQLRequestMixin._rollback_savepoint,
+        ) as rollback_savepoint:
+            with sql_export._execute_sql_request(mode="iter", header=True) as rows:
+                self.assertEqual(next(rows), ["value"])
+                self.assertEqual(
+                    [row[0] for row in rows], list(range(1, ITER_SIZE * 2 + 2))
+                )
+                rollback_savepoint.assert_not_called()
+            rollback_savepoint.assert_called_once()
+
+    def test_sql_query_iter_interrupted(self):
+        sql_export = self._get_iter_sql_export()
+        with patch.object(
+            SQLRequestMixin,
+            "_rollback_savepoint",
+            autospec=True,
+            side_effect=SQLRequestMixin._rollback_savepoint,
+        ) as rollback_savepoint:
+            with self.assertRaises(ValueError):
+                with sql_export._execute_sql_request(mode="iter") as rows:
+                    self.assertEqual(next(rows), (1,))
+                    raise ValueError()
+            # The savepoint is rolled back when leaving the context, even if
+            # the iteration is interrupted
+            rollback_savepoint.assert_called_once()
+        # The server-side cursor is closed when leaving the context
+        self.env.cr.execute("SELECT count(*) FROM pg_cursors")
+        self.assertEqual(self.env.cr.fetchone()[0], 0)
+
     def test_sql_query_with_params(self):
         query = self.env.ref("sql_export.sql_export_partner_with_variables")
         query.write({"state": "sql_valid"})
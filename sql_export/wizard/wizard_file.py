@@ -6,7 +6,6 @@ from datetime import datetime
 
 from odoo import _, fields, models
 from odoo.exceptions import UserError
-from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT
 
 
 class SqlFileWizard(models.TransientModel):
@@ -25,6 +24,8 @@ class SqlFileWizard(models.TransientModel):
     def export_sql(self):
         self.ensure_one()
 
+        # read() is required here: accessing the field directly only returns
+        # the values, without the definitions (string, type) used below
         properties = self.read(["query_properties"])[0]["query_properties"]
 
         # Check properties
@@ -38,23 +39,22 @@ class SqlFileWizard(models.TransientModel):
         sql_export = self.sql_export_id
 
         # Manage Params
-        variable_dict = {}
         now_tz = fields.Datetime.context_timestamp(sql_export, datetime.now())
-        date = now_tz.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
-        for prop in properties:
-            if prop["type"] == "many2many":
-                m2m_ids = []
-                for m2m_id in prop["value"]:
-                    m2m_ids.append(m2m_id[0])
-                variable_dict[prop["string"]] = tuple(m2m_ids)
-            else:
-                variable_dict[prop["string"]] = prop["value"]
-        if "%(company_id)s" in sql_export.query:
-            company_id = self.env.company.id
-            variable_dict["company_id"] = company_id
-        if "%(user_id)s" in sql_export.query:
-            user_id = self.env.user.id
-            variable_dict["user_id"] = user_id
+        # Same result as strftime(DEFAULT_SERVER_DATETIME_FORMAT), without
+        # the timezone offset that isoformat() adds on aware datetimes
+        date = now_tz.replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+        variable_dict = {
+            prop["string"]: (
+                tuple(m2m_id[0] for m2m_id in prop["value"])
+                if prop["type"] == "many2many"
+                else prop["value"]
+            )
+            for prop in properties
+        }
+        if sql_export.use_company_id_param:
+            variable_dict["company_id"] = self.env.company.id
+        if sql_export.use_user_id_param:
+            variable_dict["user_id"] = self.env.user.id
 
         # Call different method depending on file_type since the logic will be
         # different
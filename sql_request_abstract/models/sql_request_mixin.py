@@ -4,13 +4,16 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
 import base64
+import contextlib
+import functools
+import io
 import logging
 import re
-import uuid
-from io import BytesIO
+import secrets
+import tempfile
 
 from psycopg2 import ProgrammingError
-from psycopg2.sql import SQL
+from psycopg2.sql import SQL, Literal
 
 from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError, ValidationError
@@ -19,6 +22,100 @@ from ..sql_db import get_external_cursor
 
 logger = logging.getLogger(__name__)
 
+# Size above which the result of a 'stdout' request is written on disk
+STDOUT_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Size of the chunks encoded in base64. (Multiple of 3, so that the encoded
+# chunks can be concatenated without padding)
+STDOUT_ENCODE_CHUNK_SIZE = 57 * 1024
+
+# Number of rows fetched at once by the server-side cursor, in 'iter' mode
+ITER_SIZE = 2000
+
+# Maximum number of rows displayed when previewing a request
+PREVIEW_LIMIT = 100
+
+# Maximum number of requests checked in a single savepoint
+CHECK_EXECUTION_BATCH_SIZE = 1000
+
+# Keywords a query can start with
+QUERY_FIRST_KEYWORDS = ("select", "with", "values", "table")
+
+# Regex matching the whitespace and the line comments, that can precede
+# the first token of a query
+QUERY_BLANK_REGEX = re.compile(r"\s+|--[^\n]*")
+
+# Regex matching the first token of a query
+QUERY_FIRST_TOKEN_REGEX = re.compile(r"\(|\w+")
+
+# Regex matching the delimiters of the block comments, that can be nested
+BLOCK_COMMENT_DELIMITER_REGEX = re.compile(r"/\*|\*/")
+
+# Regex matching the parts of a query that can contain parenthesis or quotes
+# that are not part of the syntax (line comments, literals, quoted
+# identifiers), the start of the block comments, the parenthesis, and
+# unterminated quotes
+QUERY_TOKEN_REGEX = re.compile(
+    r"""
+    --[^\n]*
+    | (?P<block_comment>/\*)
+    | (?<!\w)[eE]'(?:[^'\\]|\\.|'')*'
+    | '(?:[^']|'')*'
+    | "(?:[^"]|"")*"
+    | \$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$
+    | (?P<paren>[()])
+    | (?P<unterminated>['"])
+    """,
+    re.DOTALL | re.VERBOSE,
+)
+
+
+def _skip_block_comment(query, pos):
+    """Return the position after the block comment starting at pos, that
+    can contain nested block comments, or -1 if it is unterminated."""
+    depth = 0
+    for delimiter in BLOCK_COMMENT_DELIMITER_REGEX.finditer(query, pos):
+        depth += 1 if delimiter.group() == "/*" else -1
+        if not depth:
+            return delimiter.end()
+    return -1
+
+
+def _get_query_first_token(query):
+    """Return the first token of the query, after the whitespace and the
+    comments, or None if there is no such token."""
+    pos = 0
+    while pos >= 0:
+        if blank := QUERY_BLANK_REGEX.match(query, pos):
+            pos = blank.end()
+        elif query.startswith("/*", pos):
+            pos = _skip_block_comment(query, pos)
+        else:
+            token = QUERY_FIRST_TOKEN_REGEX.match(query, pos)
+            return token.group() if token else None
+    return None
+
+
+def _iter_named_cursor_rows(named_cr, header):
+    """Yield the rows of the executed named cursor, preceded by the header
+    if asked."""
+    # The description of a named cursor is only available
+    # after the first fetch
+    rows = named_cr.fetchmany(ITER_SIZE)
+    if header:
+        yield [column.name for column in named_cr.description]
+    yield from rows
+    yield from named_cr
+
+
+@functools.lru_cache
+def _get_prohibited_words_regex(words):
+    """Return a regex matching any of the given words, compiled once
+    for a given tuple of prohibited words."""
+    return re.compile(
+        r"\b({})\b".format("|".join(map(re.escape, words))), re.IGNORECASE
+    )
+
 
 class SQLRequestMixin(models.AbstractModel):
     _name = "sql.request.mixin"
@@ -30,8 +127,12 @@ class SQLRequestMixin(models.AbstractModel):
 
     _check_prohibited_words_enabled = True
 
+    _check_syntax_enabled = True
+
     _check_execution_enabled = True
 
+    _check_execution_batch_enabled = True
+
     _sql_request_groups_relation = False
 
     _sql_request_users_relation = False
@@ -135,13 +236,14 @@ class SQLRequestMixin(models.AbstractModel):
     # Action Section
     def button_validate_sql_expression(self):
         for item in self:
-            if item._clean_query_enabled:
-                item._clean_query()
-            if item._check_prohibited_words_enabled:
-                item._check_prohibited_words()
-            if item._check_execution_enabled:
-                item._check_execution()
-            item.state = "sql_valid"
+            item._check_query_text()
+        if self._check_execution_enabled:
+            if len(self) > 1 and self._check_execution_batch_enabled:
+                self._check_execution_batch()
+            else:
+                for item in self:
+                    item._check_execution()
+        self.write({"state": "sql_valid"})
 
     def button_set_draft(self):
         self.write(
@@ -177,6 +279,14 @@ class SQLRequestMixin(models.AbstractModel):
                 result of 'cr.fetchall()'.
             * 'fetchone' : execute the select request, and return the
                 result of 'cr.fetchone()'
+            * 'iter': execute the select request in a server-side cursor,
+                and return a context manager, giving an iterator on the
+                rows, fetched by chunks. The savepoint is rolled back when
+                leaving the context, so the cursor must not be written to
+                while iterating. Ex:
+                    with request._execute_sql_request(mode="iter") as rows:
+                        for row in rows:
+                            ...
         :param rollback: (boolean) mention if a rollback should be played after
             the execution of the query. Please keep this feature enabled
             for security reason, except if necessary.
@@ -187,8 +297,9 @@ class SQLRequestMixin(models.AbstractModel):
             "COPY request STDOUT WITH xxx" request.
             (Ignored if @mode != 'stdout')
         :param header: (boolean) if true, the header of the query will be
-            returned as first element of the list if the mode is fetchall.
-            (Ignored if @mode != fetchall)
+            returned as first element of the list if the mode is fetchall,
+            or as first element of the rows if the mode is iter.
+            (Ignored if @mode not in ('fetchall', 'iter'))
 
         ..note:: The following exceptions could be raised:
             psycopg2.ProgrammingError: Error in the SQL Request.
@@ -206,20 +317,25 @@ class SQLRequestMixin(models.AbstractModel):
         if mode in ("view", "materialized_view"):
             rollback = False
 
-        query = self.env.cr.mogrify(self.query, params).decode("utf-8")
+        if params is None:
+            query = self.query
+        else:
+            query = self.env.cr.mogrify(self.query, params).decode("utf-8")
 
         if mode in ("fetchone", "fetchall"):
             pass
+        elif mode == "iter":
+            return self._iter_sql_request(query, rollback, header)
         elif mode == "stdout":
             query = SQL("COPY ({0}) TO STDOUT WITH {1}").format(
                 SQL(query), SQL(copy_options)
             )
-        elif mode in "view":
-            query = SQL("CREATE VIEW {0} AS ({1});").format(SQL(query), SQL(view_name))
-        elif mode in "materialized_view":
+        elif mode == "view":
+            query = SQL("CREATE VIEW {0} AS ({1});").format(SQL(view_name), SQL(query))
+        elif mode == "materialized_view":
             self._check_materialized_view_available()
             query = SQL("CREATE MATERIALIZED VIEW {0} AS ({1});").format(
-                SQL(query), SQL(view_name)
+                SQL(view_name), SQL(query)
             )
         else:
             raise UserError(_("Unimplemented mode : '%s'") % mode)
@@ -230,17 +346,19 @@ class SQLRequestMixin(models.AbstractModel):
             rollback_name = self._create_savepoint(query_cr)
         try:
             if mode == "stdout":
-                output = BytesIO()
-                query_cr.copy_expert(query, output)
-                res = base64.b64encode(output.getvalue())
-                output.close()
+                with tempfile.SpooledTemporaryFile(
+                    max_size=STDOUT_SPOOL_MAX_SIZE
+                ) as output:
+                    query_cr.copy_expert(query, output)
+                    output.seek(0)
+                    res = self._b64encode_file(output)
             else:
                 query_cr.execute(query)
                 if mode == "fetchall":
                     res = query_cr.fetchall()
                     if header:
-                        colnames = [desc[0] for desc in self.env.cr.description]
-                        res.insert(0, colnames)
+                        colnames = [column.name for column in query_cr.description]
+                        res = [colnames, *res]
                 elif mode == "fetchone":
                     res = query_cr.fetchone()
         finally:
@@ -249,6 +367,37 @@ class SQLRequestMixin(models.AbstractModel):
         return res
 
     # Private Section
+    @contextlib.contextmanager
+    def _iter_sql_request(self, query, rollback, header):
+        """Context manager used by _execute_sql_request in 'iter' mode, that
+        gives an iterator streaming the rows of the query with a named
+        (server-side) cursor. The cursor is closed and the savepoint is
+        rolled back when leaving the context."""
+        query_cr = self._get_cr_for_query()
+        if rollback:
+            rollback_name = self._create_savepoint(query_cr)
+        named_cr = query_cr.connection.cursor(
+            name="{}_{}".format(self._name.replace(".", "_"), secrets.token_hex(8))
+        )
+        named_cr.itersize = ITER_SIZE
+        try:
+            named_cr.execute(query)
+            yield _iter_named_cursor_rows(named_cr, header)
+        finally:
+            named_cr.close()
+            if rollback:
+                self._rollback_savepoint(rollback_name, query_cr)
+
+    @api.model
+    def _b64encode_file(self, file):
+        """Encode the content of the file in base64, chunk by chunk, to
+        avoid to load the whole raw content in memory."""
+        encoded = io.BytesIO()
+        while chunk := file.read(STDOUT_ENCODE_CHUNK_SIZE):
+            encoded.write(base64.b64encode(chunk))
+        # getvalue() returns the buffer of the BytesIO without copying it
+        return encoded.getvalue()
+
     def _get_cr_for_query(self):
         self.ensure_one()
         if self.use_external_database:
@@ -258,7 +407,9 @@ class SQLRequestMixin(models.AbstractModel):
 
     @api.model
     def _create_savepoint(self, cr):
-        rollback_name = "{}_{}".format(self._name.replace(".", "_"), uuid.uuid1().hex)
+        rollback_name = "{}_{}".format(
+            self._name.replace(".", "_"), secrets.token_hex(8)
+        )
         # pylint: disable=sql-injection
         req = f"SAVEPOINT {rollback_name}"
         cr.execute(req)
@@ -275,46 +426,86 @@ class SQLRequestMixin(models.AbstractModel):
 
     @api.model
     def _check_materialized_view_available(self):
-        self.env.cr.execute("SHOW server_version;")
-        res = self.env.cr.fetchone()[0].split(".")
-        minor_version = float(".".join(res[:2]))
-        if minor_version < 9.3:
+        # The version is known by the connection, no need to request it.
+        # (Ex: 90300 for 9.3.0)
+        server_version = self.env.cr.connection.server_version
+        if server_version < 90300:
             raise UserError(
                 _(
                     "Materialized View requires PostgreSQL 9.3 or greater but"
                     " PostgreSQL %s is currently installed."
                 )
-                % (minor_version)
+                % (f"{server_version // 10000}.{server_version // 100 % 100}")
             )
 
+    def _check_query_text(self):
+        """Clean and check the text of the query, without executing it."""
+        self.ensure_one()
+        if self._clean_query_enabled:
+            self._clean_query()
+        if self._check_prohibited_words_enabled:
+            self._check_prohibited_words()
+        if self._check_syntax_enabled:
+            self._check_syntax()
+
     def _clean_query(self):
         self.ensure_one()
-        query = self.query.strip()
-        while query[-1] == ";":
-            query = query[:-1]
-        self.query = query
+        self.query = self.query.strip().rstrip(";")
 
     def _check_prohibited_words(self):
         """Check if the query contains prohibited words, to avoid maliscious
         SQL requests"""
         self.ensure_one()
-        query = self.query.lower()
-        for word in self.PROHIBITED_WORDS:
-            expr = rf"\b{word}\b"
-            is_not_safe = re.search(expr, query)
-            if is_not_safe:
+        regex = _get_prohibited_words_regex(tuple(self.PROHIBITED_WORDS))
+        is_not_safe = regex.search(self.query)
+        if is_not_safe:
+            raise UserError(
+                _("The query is not allowed because it contains unsafe word '%s'")
+                % (is_not_safe.group(1).lower())
+            )
+
+    def _check_syntax(self):
+        """Cheap check of the query syntax, to reject obviously invalid
+        queries without requesting the database: the query should start
+        with a keyword of a select query or a parenthesis, and the
+        parenthesis, quotes and comments should be balanced."""
+        self.ensure_one()
+        first_token = _get_query_first_token(self.query)
+        if not first_token or first_token.lower() not in QUERY_FIRST_KEYWORDS + ("(",):
+            raise UserError(
+                _("The SQL query is not valid:\n\n %s")
+                % _(
+                    "The query should start with SELECT, WITH, VALUES, TABLE"
+                    " or a parenthesis."
+                )
+            )
+        depth = 0
+        pos = 0
+        while token := QUERY_TOKEN_REGEX.search(self.query, pos):
+            pos = token.end()
+            if token.group("block_comment"):
+                pos = _skip_block_comment(self.query, token.start())
+            if pos < 0 or token.group("unterminated"):
                 raise UserError(
-                    _(
-                        "The query is not allowed because it contains unsafe word"
-                        " '%s'"
-                    )
-                    % (word)
+                    _("The SQL query is not valid:\n\n %s")
+                    % _("Unterminated quoted string or comment.")
                 )
+            paren = token.group("paren")
+            if paren:
+                depth += 1 if paren == "(" else -1
+                if depth < 0:
+                    break
+        if depth:
+            raise UserError(
+                _("The SQL query is not valid:\n\n %s") % _("Unbalanced parenthesis.")
+            )
 
     def _check_execution(self):
         """Ensure that the query is valid, trying to execute it. A rollback
         is done after."""
         self.ensure_one()
+        if not self._check_execution_required():
+            return True
         query = self._prepare_request_check_execution()
         query_cr = self._get_cr_for_query()
         rollback_name = self._create_savepoint(query_cr)
@@ -329,11 +520,55 @@ class SQLRequestMixin(models.AbstractModel):
             self._rollback_savepoint(rollback_name, query_cr)
         return res
 
+    def _check_execution_batch(self):
+        """Same as _check_execution, for many requests: the requests are
+        executed by batch, within a single savepoint, to reduce the number
+        of round-trips with the database. A rollback is done after each
+        batch.
+        As _check_execution is not called, disable
+        _check_execution_batch_enabled if _check_execution is overloaded."""
+        requests = self.filtered(lambda x: x._check_execution_required())
+        for use_external_database in (False, True):
+            requests_by_database = requests.filtered_domain(
+                [("use_external_database", "=", use_external_database)]
+            )
+            for batch in tools.split_every(
+                CHECK_EXECUTION_BATCH_SIZE, requests_by_database.ids, self.browse
+            ):
+                query_cr = batch[0]._get_cr_for_query()
+                rollback_name = self._create_savepoint(query_cr)
+                try:
+                    for item in batch:
+                        query = item._prepare_request_check_execution()
+                        try:
+                            query_cr.execute(query)
+                        except ProgrammingError as e:
+                            logger.exception("Failed query: %s", query)
+                            raise UserError(
+                                _("The SQL query %(name)s is not valid:\n\n %(error)s")
+                                % {"name": item.name, "error": e}
+                            ) from e
+                        item._hook_executed_request()
+                finally:
+                    self._rollback_savepoint(rollback_name, query_cr)
+
+    def _check_execution_required(self):
+        """Overload me to skip the check of the execution of some requests,
+        for example if the query can't be executed without parameters."""
+        self.ensure_one()
+        return True
+
     def _prepare_request_check_execution(self):
         """Overload me to replace some part of the query, if it contains
-        parameters"""
+        parameters.
+        By default, the query is wrapped in a 'LIMIT 0' request, so that
+        PostgreSQL parses and plans it, raising the same errors, without
+        scanning the data. (The parenthesis is closed on a new line, in
+        case the query ends with a comment)"""
         self.ensure_one()
-        return self.query
+        return SQL("SELECT * FROM ({query}\n) AS validation LIMIT 0").format(
+            query=SQL(self.query)
+        )
 
     def _hook_executed_request(self):
         """Overload me to insert custom code, when the SQL request has
@@ -342,7 +577,28 @@ class SQLRequestMixin(models.AbstractModel):
         self.ensure_one()
         return False
 
+    def _get_preview_rows(self):
+        """Execute the query, limited to the first rows, and return them.
+        As the query is executed, this also ensures that it is valid.
+        A rollback is done after."""
+        self.ensure_one()
+        query = SQL("SELECT * FROM ({query}\n) AS preview LIMIT {limit}").format(
+            query=SQL(self.query), limit=Literal(PREVIEW_LIMIT)
+        )
+        query_cr = self._get_cr_for_query()
+        rollback_name = self._create_savepoint(query_cr)
+        try:
+            query_cr.execute(query)
+            return query_cr.fetchall()
+        except ProgrammingError as e:
+            logger.exception("Failed query: %s", query)
+            raise UserError(_("The SQL query is not valid:\n\n %s") % e) from e
+        finally:
+            self._rollback_savepoint(rollback_name, query_cr)
+
     def button_preview_sql_expression(self):
-        self.button_validate_sql_expression()
-        res = self._execute_sql_request()
-        raise UserError("\n".join(map(lambda x: str(x), res[:100])))
+        # The preview request checks the query validity, so the query is not
+        # executed a second time by _check_execution
+        self._check_query_text()
+        res = self._get_preview_rows()
+        raise UserError("\n".join(map(str, res)))